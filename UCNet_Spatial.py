@@ -8,18 +8,22 @@ from pathlib import Path
 import copy
 import logging
 import random
-import scipy.io as sio
 import time
-import math
+import functools
+import atexit
+import shutil
+import tempfile
 
 import torch
 import torch.nn as nn
 import torch.optim as optim
 from torch.utils.data.dataset import Dataset
 from torch.utils.data import DataLoader
+from torch.utils.data.dataloader import default_collate
 from torchvision import transforms
 from torch.nn.parameter import Parameter
 import torch.nn.functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 from srm_filter_kernel import all_normalized_hpf_list
 
 
@@ -31,17 +35,24 @@ WEIGHT_DECAY = 5e-4
 TRAIN_FILE_COUNT = 14000
 TRAIN_PRINT_FREQUENCY = 100
 EVAL_PRINT_FREQUENCY = 1
+BN_ADJUST_BATCHES = 200
 
 OUTPUT_PATH = Path(__file__).stem
 
+CACHE_DIR = '/dev/shm'  # decoded images are kept here after the first epoch
+
 
 class TLU(nn.Module):
-    def __init__(self, threshold):
+    def __init__(self, threshold, inplace=False):
         super(TLU, self).__init__()
 
         self.threshold = threshold
+        self.inplace = inplace
 
     def forward(self, input):
+        if self.inplace:
+            return input.clamp_(min=-self.threshold, max=self.threshold)
+
         output = torch.clamp(input, min=-self.threshold, max=self.threshold)
 
         return output
@@ -69,21 +80,31 @@ def build_filters():
     return filters
 
 
+@functools.lru_cache(maxsize=None)
+def build_hpf_weight():
+    # built once per process, HPF() copies it via repeat()
+    return torch.from_numpy(np.stack(build_filters())).float().view(62, 1, 5, 5)
+
+
 class HPF(nn.Module):
     def __init__(self):
         super(HPF, self).__init__()
 
-        filt_list = build_filters()
-        hpf_weight = nn.Parameter(torch.Tensor(filt_list).view(62, 1, 5, 5), requires_grad=False)
+        # same 62 filters for each color channel, applied in a single grouped conv
+        hpf_weight = build_hpf_weight().repeat(3, 1, 1, 1)
+        hpf_weight = nn.Parameter(hpf_weight, requires_grad=False)
 
-        self.hpf = nn.Conv2d(1, 62, kernel_size=5, padding=2, bias=False)
+        self.hpf = nn.Conv2d(3, 186, kernel_size=5, padding=2, groups=3, bias=False)
         self.hpf.weight = hpf_weight
 
-        self.tlu = TLU(2.0)  # T= 2
+        self.tlu = TLU(2.0, inplace=True)  # T= 2
 
     def forward(self, input):
-        output = self.hpf(input)
-        output = self.tlu(output)
+        # fixed filters on the raw input, nothing here needs a graph; kept in fp32
+        # since the normalized SRM kernels are not exact in fp16 and stop summing to zero
+        with torch.no_grad(), torch.cuda.amp.autocast(enabled=False):
+            output = self.hpf(input.float())
+            output = self.tlu(output)
 
         return output  
 
@@ -151,7 +172,7 @@ class Type3(nn.Module):
                 nn.Conv2d(inchannel, outchannel, kernel_size=1),
                 nn.BatchNorm2d(outchannel),
                 nn.ReLU(),
-                nn.Conv2d(outchannel, outchannel, kernel_size=3, stride=2, groups=32, padding=1),
+                nn.Conv2d(outchannel, outchannel, kernel_size=3, stride=2, groups=outchannel, padding=1),
                 nn.BatchNorm2d(outchannel),
                 nn.ReLU(),
                 nn.Conv2d(outchannel, outchannel, kernel_size=1),
@@ -174,35 +195,24 @@ class Net(nn.Module):
     
     self.pre = HPF()
 
-    self.group1 = type1(186,32)
-    self.group2 = type2(32,32)
-    self.group3 = type3(32,64)
-    self.group4 = type2(64,128)
-    self.group5 = type1(128,256)
+    self.trunk = nn.Sequential(
+        Type1(186, 32),
+        Type2(32, 32),
+        Type3(32, 64),
+        Type2(64, 128),
+        Type1(128, 256),
+        )
     
-    self.avg = nn.AvgPool2d(kernel_size=32, stride=1)
+    self.avg = nn.AdaptiveAvgPool2d(1)
     self.fc1 = nn.Linear(1 * 1 * 256, 2)
 
   def forward(self, input):
     output = input
     
-    # seperate color channels
-    output_c1 = output[:, 0, :, :]
-    output_c2 = output[:, 1, :, :] 
-    output_c3 = output[:, 2, :, :] 
-    out_c1 = output_c1.unsqueeze(1)
-    out_c2 = output_c2.unsqueeze(1)
-    out_c3 = output_c3.unsqueeze(1)
-    c1 = self.pre(out_c1)
-    c2 = self.pre(out_c2)
-    c3 = self.pre(out_c3)
-    output = torch.cat([c1, c2, c3], dim=1)
+    # filter each color channel separately (grouped conv)
+    output = self.pre(output)
     
-    output = self.group1(output)
-    output = self.group2(output)
-    output = self.group3(output)
-    output = self.group4(output)
-    output = self.group5(output)
+    output = self.trunk(output)
     
     output = self.avg(output)
     output = output.view(output.size(0), -1)
@@ -228,10 +238,11 @@ class AverageMeter(object):
         self.avg = self.sum / self.count
 
 
-def train(model, device, train_loader, optimizer, epoch):
+def train(model, device, train_loader, optimizer, scaler, criterion, epoch):
     batch_time = AverageMeter()  
     data_time = AverageMeter()
     losses = AverageMeter()
+    aug_data = AugData()
 
     model.train()
 
@@ -243,25 +254,23 @@ def train(model, device, train_loader, optimizer, epoch):
 
         data, label = sample['data'], sample['label']
 
-        shape = list(data.size())
-        data = data.reshape(shape[0] * shape[1], *shape[2:])
-        label = label.reshape(-1)
-
-        data, label = data.to(device), label.to(device)
+        data = aug_data(data.to(device, non_blocking=True))
+        data = data.contiguous(memory_format=torch.channels_last)
+        label = label.to(device, non_blocking=True)
 
         optimizer.zero_grad()
 
         end = time.time()
 
-        output = model(data)  
-
-        criterion = nn.CrossEntropyLoss()
-        loss = criterion(output, label)
+        with torch.cuda.amp.autocast():
+            output = model(data)
+            loss = criterion(output, label)
 
         losses.update(loss.item(), data.size(0))
 
-        loss.backward()  
-        optimizer.step()
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
 
         batch_time.update(time.time() - end)  
         end = time.time()
@@ -276,23 +285,51 @@ def train(model, device, train_loader, optimizer, epoch):
 
 
 def adjust_bn_stats(model, device, train_loader):
+    aug_data = AugData()
+
+    # short no_grad pass, run eagerly: momentum=None would graph-break the compiled model at every BN
+    model = unwrapModel(model)
+
+    # recompute running stats as a cumulative average over a subset of batches
+    bn_layers = [m for m in model.modules() if isinstance(m, nn.BatchNorm2d)]
+    bn_momentum = [m.momentum for m in bn_layers]
+    for m in bn_layers:
+        m.reset_running_stats()
+        m.momentum = None
+
     model.train()
 
     with torch.no_grad():
-        for sample in train_loader:
-            data, label = sample['data'], sample['label']
+        for i, sample in enumerate(train_loader):
+            if i >= BN_ADJUST_BATCHES:
+                break
 
-            shape = list(data.size())
-            data = data.reshape(shape[0] * shape[1], *shape[2:])
-            label = label.reshape(-1)
+            data = aug_data(sample['data'].to(device, non_blocking=True))
+            data = data.contiguous(memory_format=torch.channels_last)
 
-            data, label = data.to(device), label.to(device)
+            model(data)
 
-            output = model(data)
+    for m, momentum in zip(bn_layers, bn_momentum):
+        m.momentum = momentum
+
+
+def fuseConvBn(model):
+    # eval-only copy with every Conv2d -> BatchNorm2d pair folded into one conv
+    fused = copy.deepcopy(unwrapModel(model)).eval()
 
+    for module in fused.modules():
+        if isinstance(module, nn.Sequential):
+            for i in range(len(module) - 1):
+                if isinstance(module[i], nn.Conv2d) and isinstance(module[i + 1], nn.BatchNorm2d):
+                    module[i] = fuse_conv_bn_eval(module[i], module[i + 1])
+                    module[i + 1] = nn.Identity()
 
-def evaluate(model, device, eval_loader, epoch, optimizer, best_acc, PARAMS_PATH, TMP):
+    return fused
+
+
+def evaluate(model, device, eval_loader, epoch, optimizer, scaler, best_acc, PARAMS_PATH, TMP):
     model.eval()
+    fused_model = fuseConvBn(model)
 
     test_loss = 0
     correct = 0
@@ -301,13 +338,10 @@ def evaluate(model, device, eval_loader, epoch, optimizer, best_acc, PARAMS_PATH
         for sample in eval_loader:
             data, label = sample['data'], sample['label']
 
-            shape = list(data.size())
-            data = data.reshape(shape[0] * shape[1], *shape[2:])
-            label = label.reshape(-1)
+            data = data.to(device, non_blocking=True, memory_format=torch.channels_last)
+            label = label.to(device, non_blocking=True)
 
-            data, label = data.to(device), label.to(device)
-
-            output = model(data)
+            output = fused_model(data)
             pred = output.max(1, keepdim=True)[1]
             correct += pred.eq(label.view_as(pred)).sum().item()
 
@@ -316,8 +350,9 @@ def evaluate(model, device, eval_loader, epoch, optimizer, best_acc, PARAMS_PATH
     if accuracy > best_acc and epoch > TMP:
         best_acc = accuracy
         all_state = {
-            'original_state': model.state_dict(),
+            'original_state': unwrapModel(model).state_dict(),
             'optimizer_state': optimizer.state_dict(),
+            'scaler_state': scaler.state_dict(),
             'epoch': epoch
         }
         torch.save(all_state, PARAMS_PATH)
@@ -329,6 +364,11 @@ def evaluate(model, device, eval_loader, epoch, optimizer, best_acc, PARAMS_PATH
     return best_acc
 
 
+def unwrapModel(model):
+    # torch.compile wraps the module, checkpoints keep the plain Net keys
+    return getattr(model, '_orig_mod', model)
+
+
 def initWeights(module):
     if type(module) == nn.Conv2d:
         if module.weight.requires_grad:
@@ -344,19 +384,21 @@ def initWeights(module):
 
 
 class AugData():
-    def __call__(self, sample):
-        data, label = sample['data'], sample['label']
+    # runs on the GPU batch (2B, C, H, W), cover and stego of a pair share one rot/flip
+    def __call__(self, data):
+        pairs = data.view(-1, 2, *data.shape[1:])
+
+        return torch.stack([self.augment(pair) for pair in pairs]).view_as(data)
 
+    def augment(self, pair):
         rot = random.randint(0, 3)
 
-        data = np.rot90(data, rot, axes=[2, 3]).copy()  # gaiwei [2,3]
+        pair = torch.rot90(pair, rot, dims=(2, 3))
 
         if random.random() < 0.5:
-            data = np.flip(data, axis=2).copy()
-
-        new_sample = {'data': data, 'label': label}
+            pair = torch.flip(pair, dims=(2,))
 
-        return new_sample
+        return pair
 
 
 class ToTensor():
@@ -366,14 +408,16 @@ class ToTensor():
         data = data.astype(np.float32)
 
         new_sample = {
-            'data': torch.from_numpy(data),
-            'label': torch.from_numpy(label).long(),
+            'data': torch.as_tensor(data),
+            'label': torch.as_tensor(label, dtype=torch.long),
         }
 
         return new_sample
 
 
 class MyDataset(Dataset):
+    label = torch.tensor([0, 1], dtype=torch.long)  # cover, stego
+
     def __init__(self, index_path, ALASKA_COVER_DIR, ALASKA_STEGO_DIR, transform=None):
         self.index_list = np.load(index_path)
         self.transform = transform
@@ -381,31 +425,97 @@ class MyDataset(Dataset):
         self.alaska_cover_path = ALASKA_COVER_DIR + '/{}.ppm'
         self.alaska_stego_path = ALASKA_STEGO_DIR + '/{}.ppm'
 
+        # uint8 pairs decoded once, then served from a memmap shared by all workers
+        self.cache_path = None
+        self.cache_shape = (len(self), 2, 3, IMAGE_SIZE, IMAGE_SIZE)
+        self.cache = None
+        self.cached = None
+
     def __len__(self):
         return self.index_list.shape[0]
 
     def __getitem__(self, idx):
+        if not self.cache_path:
+            data = self.load(idx)
+        else:
+            if self.cache is None:
+                # opened lazily so each worker maps the file itself
+                self.cache = np.memmap(self.cache_path, dtype='uint8', mode='r+', shape=self.cache_shape)
+                self.cached = np.memmap(self.cache_path + '.done', dtype='uint8', mode='r+', shape=(len(self),))
+
+            if self.cached[idx]:
+                data = self.cache[idx]
+            else:
+                data = self.load(idx)
+                if data.shape != self.cache_shape[1:] or data.dtype != np.uint8:
+                    raise ValueError('Cannot cache {} / {}: decoded to {} {}, the cache holds {} uint8'.format(
+                        self.alaska_cover_path.format(self.index_list[idx]),
+                        self.alaska_stego_path.format(self.index_list[idx]),
+                        data.shape, data.dtype, self.cache_shape[1:]))
+                self.cache[idx] = data
+                self.cached[idx] = 1
+
+        label = self.label
+
+        sample = {'data': data, 'label': label}
+
+        if self.transform:
+            sample = self.transform(sample)
+
+        return sample
+
+    def load(self, idx):
         file_index = self.index_list[idx]
 
         cover_path = self.alaska_cover_path.format(file_index)
         stego_path = self.alaska_stego_path.format(file_index)
 
         cover_data = cv2.imread(cover_path, -1)
-        cover_data = cv2.cvtColor(cover_data, cv2.COLOR_BGR2RGB)
-        cover_data = np.transpose(cover_data, (2, 0, 1))
         stego_data = cv2.imread(stego_path, -1)
-        stego_data = cv2.cvtColor(stego_data, cv2.COLOR_BGR2RGB)
-        stego_data = np.transpose(stego_data, (2, 0, 1))
+        for path, img in ((cover_path, cover_data), (stego_path, stego_data)):
+            if img is None:
+                raise IOError('Cannot read image {}'.format(path))
 
-        data = np.stack([cover_data, stego_data])
-        label = np.array([0, 1], dtype='int32')
+        # BGR -> RGB and HWC -> CHW as views, np.stack does the only copy
+        cover_data = cover_data[..., ::-1].transpose(2, 0, 1)
+        stego_data = stego_data[..., ::-1].transpose(2, 0, 1)
 
-        sample = {'data': data, 'label': label}
+        return np.stack([cover_data, stego_data])
 
-        if self.transform:
-            sample = self.transform(sample)
+    def cacheBytes(self):
+        return int(np.prod(self.cache_shape)) + len(self)
 
-        return sample
+    def createCache(self, cache_dir, prefix):
+        # must run before the loader starts its workers; the file name is unique per run
+        # and removed at interpreter exit, also after an exception or Ctrl-C
+        fd, self.cache_path = tempfile.mkstemp(prefix=prefix, suffix='.dat', dir=cache_dir)
+        atexit.register(self.removeCache)
+
+        # reserve the pages now (zero-filled), a sparse file would only fail with SIGBUS
+        # in a worker once /dev/shm runs out mid-epoch
+        try:
+            with os.fdopen(fd, 'r+b') as f:
+                os.posix_fallocate(f.fileno(), 0, int(np.prod(self.cache_shape)))
+            with open(self.cache_path + '.done', 'xb') as f:
+                os.posix_fallocate(f.fileno(), 0, len(self))
+        except OSError as e:
+            logging.info('Cannot reserve image cache in {} ({}), reading from disk'.format(cache_dir, e))
+            self.removeCache()
+            self.cache_path = None
+
+    def removeCache(self):
+        if self.cache_path:
+            for path in (self.cache_path, self.cache_path + '.done'):
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+def collatePairs(batch):
+    # (B, 2, C, H, W) -> (2B, C, H, W) in the worker, cover/stego stay adjacent
+    sample = default_collate(batch)
+    data, label = sample['data'], sample['label']
+
+    return {'data': data.view(-1, *data.shape[2:]), 'label': label.view(-1)}
 
 
 def setLogger(log_path, mode='a'):
@@ -429,10 +539,16 @@ def main(args):
 
     device = torch.device("cuda")
 
-    kwargs = {'num_workers': 1, 'pin_memory': True}
+    # input shape is fixed, let cuDNN pick the fastest conv algorithms once
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cudnn.deterministic = False
 
+    # keep workers alive across epochs, prefetch capped at 4 to bound pinned memory
+    kwargs = {'num_workers': min(8, os.cpu_count() or 1), 'pin_memory': True,
+              'persistent_workers': True, 'prefetch_factor': 4, 'collate_fn': collatePairs}
+
+    # rotation/flip augmentation is done on the GPU in train()
     train_transform = transforms.Compose([
-        AugData(),
         ToTensor()
     ])
 
@@ -460,8 +576,6 @@ def main(args):
     PARAMS_PATH = os.path.join(OUTPUT_PATH, PARAMS_NAME)
     LOG_PATH = os.path.join(OUTPUT_PATH, LOG_NAME)
 
-    PARAMS_INIT_PATH = os.path.join(OUTPUT_PATH, PARAMS_INIT_NAME)
-
     setLogger(LOG_PATH, mode='w')
 
     Path(OUTPUT_PATH).mkdir(parents=True, exist_ok=True)
@@ -470,12 +584,33 @@ def main(args):
     valid_dataset = MyDataset(VALID_INDEX_PATH, ALASKA_COVER_DIR, ALASKA_STEGO_DIR, eval_transform)
     test_dataset = MyDataset(TEST_INDEX_PATH, ALASKA_COVER_DIR, ALASKA_STEGO_DIR, eval_transform)
 
-    train_loader = DataLoader(train_dataset, batch_size=BATCH_SIZE, shuffle=True, **kwargs)
+    # train/valid are read every epoch, the test set only once. Leave room in /dev/shm for
+    # the shared-memory batches of all three loaders' workers (float32, 2 images per pair)
+    CACHE_BYTES = train_dataset.cacheBytes() + valid_dataset.cacheBytes()
+    CACHE_PREFIX = '{}-{}-{}-'.format(STEGANOGRAPHY, EMBEDDING_RATE, DATASET_INDEX)
+    SHM_MARGIN = 3 * kwargs['num_workers'] * kwargs['prefetch_factor'] * BATCH_SIZE * 2 * 3 * IMAGE_SIZE * IMAGE_SIZE * 4
+
+    if shutil.disk_usage(CACHE_DIR).free > CACHE_BYTES + SHM_MARGIN:
+        train_dataset.createCache(CACHE_DIR, CACHE_PREFIX + 'train-')
+        valid_dataset.createCache(CACHE_DIR, CACHE_PREFIX + 'valid-')
+    else:
+        logging.info('Not enough space in {} for the image cache ({:.1f} GB), reading from disk'.format(
+            CACHE_DIR, CACHE_BYTES / 1e9))
+
+    # every train batch has the same shape, so the compiled CUDA graphs are never re-recorded
+    train_loader = DataLoader(train_dataset, batch_size=BATCH_SIZE, shuffle=True, drop_last=True, **kwargs)
     valid_loader = DataLoader(valid_dataset, batch_size=BATCH_SIZE, shuffle=False, **kwargs)
     test_loader = DataLoader(test_dataset, batch_size=BATCH_SIZE, shuffle=False, **kwargs)
 
     model = Net().to(device)
     model.apply(initWeights)
+    # NHWC lets cuDNN use its Tensor Core kernels under autocast
+    model = model.to(memory_format=torch.channels_last)
+
+    if hasattr(torch, 'compile'):
+        # input shape never changes, so a static graph avoids recompiles;
+        # max-autotune also replays forward/backward as CUDA graphs
+        model = torch.compile(model, mode='max-autotune', dynamic=False)
 
     params = model.parameters()
 
@@ -487,7 +622,13 @@ def main(args):
     param_groups = [{'params': params_wd, 'weight_decay': WEIGHT_DECAY},
                     {'params': params_rest}]
 
-    optimizer = optim.SGD(param_groups, lr=LR, momentum=0.9)
+    try:
+        # single multi-tensor kernel per step (PyTorch >= 2.3)
+        optimizer = optim.SGD(param_groups, lr=LR, momentum=0.9, fused=True)
+    except TypeError:
+        optimizer = optim.SGD(param_groups, lr=LR, momentum=0.9)
+    scaler = torch.cuda.amp.GradScaler()
+    criterion = nn.CrossEntropyLoss().to(device)
 
     EPOCHS = 250
     DECAY_EPOCH = [80, 140, 190]
@@ -505,9 +646,13 @@ def main(args):
         optimizer_state = all_state['optimizer_state']
         epoch = all_state['epoch']
 
-        model.load_state_dict(original_state)
+        unwrapModel(model).load_state_dict(original_state)
         optimizer.load_state_dict(optimizer_state)
 
+        # keep the loss scale, otherwise the first steps after resuming are skipped as inf
+        if 'scaler_state' in all_state:
+            scaler.load_state_dict(all_state['scaler_state'])
+
         startEpoch = epoch + 1
 
     else:
@@ -517,13 +662,13 @@ def main(args):
     scheduler = optim.lr_scheduler.MultiStepLR(optimizer, milestones=DECAY_EPOCH, gamma=0.1)
     best_acc = 0.0
     for epoch in range(startEpoch, EPOCHS + 1):
-        scheduler.step()
+        train(model, device, train_loader, optimizer, scaler, criterion, epoch)
 
-        train(model, device, train_loader, optimizer, epoch)
+        scheduler.step()
 
         if epoch % EVAL_PRINT_FREQUENCY == 0:
             adjust_bn_stats(model, device, train_loader)
-            best_acc = evaluate(model, device, valid_loader, epoch, optimizer, best_acc, PARAMS_PATH, TMP)
+            best_acc = evaluate(model, device, valid_loader, epoch, optimizer, scaler, best_acc, PARAMS_PATH, TMP)
 
     logging.info('\nTest set accuracy: \n')
 
@@ -531,11 +676,11 @@ def main(args):
     all_state = torch.load(PARAMS_PATH)
     original_state = all_state['original_state']
     optimizer_state = all_state['optimizer_state']
-    model.load_state_dict(original_state)
+    unwrapModel(model).load_state_dict(original_state)
     optimizer.load_state_dict(optimizer_state)
 
     adjust_bn_stats(model, device, train_loader)
-    evaluate(model, device, test_loader, epoch, optimizer, best_acc, PARAMS_PATH, TMP)
+    evaluate(model, device, test_loader, epoch, optimizer, scaler, best_acc, PARAMS_PATH, TMP)
 
 
 def myParseArgs():